@@ -3,7 +3,8 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
 from app.db import create_table, delete_tables
-from app.routers import order_router, product_router
+from app.routers import admin_router, order_router, product_router
+from app.slow_queries import SLOW_QUERY_MS
 
 
 @asynccontextmanager
@@ -19,3 +20,5 @@ app = FastAPI(lifespan=lifespan)
 
 app.include_router(product_router)
 app.include_router(order_router)
+if SLOW_QUERY_MS:
+    app.include_router(admin_router)
@@ -1,12 +1,74 @@
+from collections import defaultdict
+from typing import Any, Optional
+
 from fastapi import HTTPException
-from sqlalchemy import select
+from sqlalchemy import bindparam, insert, select, tuple_, update
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db import OrderItemModel, OrderModel, ProductModel
+from app.db import (DeletedProductModel, OrderItemModel, OrderModel,
+                    ProductModel, StatusModel, track_changes, utcnow)
 from app.schemas import (OrderAdd, OrderRead, OrderStatusUpdate, ProductAdd,
                          ProductRead)
 
+PRODUCT_FIELDS = tuple(ProductRead.model_fields)
+ORDER_FIELDS = tuple(OrderRead.model_fields)
+MAX_CHANGE_ID = 2 ** 63 - 1
+MAX_ID = 2 ** 31 - 1
+MAX_BULK_PRODUCTS = 1000
+
+
+def check_fields(fields: list[str], allowed: tuple[str, ...]) -> list[str]:
+    '''
+    Проверяет запрошенные поля и возвращает их без повторов,
+    всегда начиная с id.
+    '''
+    unknown = sorted(set(fields) - set(allowed))
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f'Неизвестные поля: {", ".join(unknown)}.')
+    return ['id'] + [field for field in dict.fromkeys(fields)
+                     if field != 'id']
+
+
+def encode_token(change_id: int, object_id: int) -> str:
+    '''Токен изменений - номер изменения и id последней записи.'''
+    return f'{change_id}_{object_id}'
+
+
+def decode_token(token: Optional[str]) -> Optional[tuple[int, int]]:
+    '''
+    Разбирает токен изменений. Значения вне диапазона колонок
+    считаются некорректным токеном, а не доходят до базы.
+    '''
+    if token is None:
+        return None
+    try:
+        change_id, object_id = map(int, token.split('_'))
+    except ValueError:
+        change_id = object_id = -1
+    if not (0 <= change_id <= MAX_CHANGE_ID and 0 <= object_id <= MAX_ID):
+        raise HTTPException(status_code=400,
+                            detail='Некорректный токен изменений.')
+    return change_id, object_id
+
+
+def changes_page(changes: list[tuple[int, int, Any]],
+                 since: Optional[str], limit: int) -> dict:
+    '''
+    Собирает страницу изменений, отсортированных по номеру изменения и id.
+    В changes должно быть до limit + 1 записей из каждого источника.
+    '''
+    changes = sorted(changes, key=lambda change: change[:2])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    if changes:
+        since = encode_token(*changes[-1][:2])
+    return {'data': [change[2] for change in changes],
+            'next': since,
+            'has_more': has_more}
+
 
 class ProductRepository:
     '''Методы для работы с товарами.'''
@@ -26,9 +88,25 @@ class ProductRepository:
         return new_product.id
 
     @classmethod
-    async def get_all(cls, session: AsyncSession) -> list[ProductRead]:
-        query = select(ProductModel)
+    async def get_all(cls, session: AsyncSession,
+                      ids: Optional[list[int]] = None,
+                      fields: Optional[list[str]] = None
+                      ) -> list[ProductRead] | list[dict]:
+        '''
+        Возвращает товары. Если переданы ids, выбирает только их
+        одним запросом, если fields - загружает только эти колонки.
+        '''
+        if fields is not None:
+            fields = check_fields(fields, PRODUCT_FIELDS)
+            query = select(*(getattr(ProductModel, field)
+                             for field in fields))
+        else:
+            query = select(ProductModel)
+        if ids is not None:
+            query = query.where(ProductModel.id.in_(ids))
         result = await session.execute(query)
+        if fields is not None:
+            return [dict(row) for row in result.mappings()]
         product_models = result.scalars().all()
         products = [ProductRead.model_validate(
             product_model
@@ -37,14 +115,51 @@ class ProductRepository:
 
     @classmethod
     async def get_product(cls, product_id: int,
-                          session: AsyncSession) -> ProductRead:
-        query = select(ProductModel).where(ProductModel.id == product_id)
-        result = await session.execute(query)
-        product_model = result.scalar_one_or_none()
-        if product_model is None:
+                          session: AsyncSession,
+                          fields: Optional[list[str]] = None
+                          ) -> ProductRead | dict:
+        products = await cls.get_all(session, ids=[product_id],
+                                     fields=fields)
+        if not products:
             raise HTTPException(status_code=404, detail='Товар не найден.')
-        product = ProductRead.model_validate(product_model)
-        return product
+        return products[0]
+
+    @classmethod
+    async def get_changes(cls, session: AsyncSession,
+                          since: Optional[str] = None,
+                          limit: int = 100) -> dict:
+        '''
+        Возвращает товары, измененные или удаленные после токена since,
+        в порядке изменения.
+        '''
+        after = decode_token(since)
+        query = select(ProductModel).order_by(
+            ProductModel.change_id, ProductModel.id).limit(limit + 1)
+        deleted_query = select(DeletedProductModel).order_by(
+            DeletedProductModel.change_id,
+            DeletedProductModel.product_id).limit(limit + 1)
+        if after is not None:
+            query = query.where(
+                tuple_(ProductModel.change_id, ProductModel.id) > after)
+            deleted_query = deleted_query.where(
+                tuple_(DeletedProductModel.change_id,
+                       DeletedProductModel.product_id) > after)
+        product_models = (await session.execute(query)).scalars().all()
+        deleted_models = (
+            await session.execute(deleted_query)).scalars().all()
+
+        changes = [(
+            product_model.change_id, product_model.id,
+            {**ProductRead.model_validate(product_model).model_dump(),
+             'deleted': False}
+        ) for product_model in product_models]
+        changes += [(
+            deleted_model.change_id, deleted_model.product_id,
+            {'id': deleted_model.product_id,
+             'updated_at': deleted_model.deleted_at,
+             'deleted': True}
+        ) for deleted_model in deleted_models]
+        return changes_page(changes, since, limit)
 
     @classmethod
     async def delete_product(cls, product_id: int,
@@ -54,6 +169,16 @@ class ProductRepository:
         product_model = result.scalar_one_or_none()
         if product_model is None:
             raise HTTPException(status_code=404, detail='Товар не найден.')
+        # Позиции заказов удаляются вместе с товаром, значит
+        # меняются и сами заказы.
+        order_ids = await session.scalars(
+            update(OrderModel).where(OrderModel.id.in_(
+                select(OrderItemModel.order_id).where(
+                    OrderItemModel.product_id == product_id)
+            )).values(updated_at=utcnow()).returning(OrderModel.id)
+        )
+        track_changes(session, OrderModel, order_ids)
+        session.add(DeletedProductModel(product_id=product_id))
         await session.delete(product_model)
         await session.commit()
         return
@@ -81,56 +206,219 @@ class OrderRepository:
     @classmethod
     async def add_order(cls, order: OrderAdd,
                         session: AsyncSession) -> int:
+        amounts = defaultdict(int)
+        for item in order.items:
+            amounts[item.name] += item.amount
+        products, stock = await cls._lock_products(set(amounts), session)
+        error = cls._check_stock(amounts, stock)
+        if error is not None:
+            raise HTTPException(**error)
+
         new_order = OrderModel(status=order.status)
         session.add(new_order)
         await session.flush()
 
-        items = order.items
-
-        for item in items:
-            query = select(ProductModel).where(ProductModel.name == item.name)
-            result = await session.execute(query)
-            product = result.scalar_one_or_none()
-            if product is None:
-                raise HTTPException(status_code=404,
-                                    detail=f'Товар {item.name} не найден.')
-            if product.in_stock < item.amount:
-                raise HTTPException(
-                    status_code=400,
-                    detail=(f'Недостаточно {item.name} для заказа. '
-                            f'Остаток на складе - {product.in_stock}'))
-            product.in_stock -= item.amount
-            session.add(product)
-
+        for item in order.items:
             orderitem = OrderItemModel(order_id=new_order.id,
-                                       product_id=product.id,
+                                       product_id=products[item.name],
                                        amount=item.amount)
             session.add(orderitem)
+        await cls._reserve_stock(
+            {products[name]: amount for name, amount in amounts.items()},
+            session)
 
         await session.flush()
         await session.commit()
         return new_order.id
 
     @classmethod
-    async def get_all(cls, session: AsyncSession) -> list[OrderRead]:
-        query = select(OrderModel)
+    async def add_orders(cls, orders: list[OrderAdd],
+                         session: AsyncSession) -> list[dict]:
+        '''
+        Создает пачку заказов в одной транзакции. Товары ищутся одним
+        запросом на всю пачку, заказы и их товары вставляются
+        многострочными запросами. Заказ, для которого не нашлось товара
+        или не хватило остатка, пропускается, остальные создаются.
+        '''
+        if not orders:
+            return []
+        products, stock = await cls._lock_products(
+            {item.name for order in orders for item in order.items}, session)
+
+        results = []
+        accepted = []
+        for index, order in enumerate(orders):
+            amounts = defaultdict(int)
+            for item in order.items:
+                amounts[item.name] += item.amount
+            error = cls._check_stock(amounts, stock)
+            if error is not None:
+                results.append({'index': index, **error})
+                continue
+            for name, amount in amounts.items():
+                stock[name] -= amount
+            results.append({'index': index, 'order_id': None})
+            accepted.append((order, results[-1]))
+
+        if not accepted:
+            return results
+
+        order_ids = (await session.scalars(
+            insert(OrderModel).returning(OrderModel.id,
+                                         sort_by_parameter_order=True),
+            [{'status': order.status or StatusModel.PENDING}
+             for order, _ in accepted]
+        )).all()
+        track_changes(session, OrderModel, order_ids)
+        reserved = defaultdict(int)
+        order_items = []
+        for (order, order_result), order_id in zip(accepted, order_ids):
+            order_result['order_id'] = order_id
+            for item in order.items:
+                reserved[products[item.name]] += item.amount
+                order_items.append({'order_id': order_id,
+                                    'product_id': products[item.name],
+                                    'amount': item.amount})
+        if order_items:
+            await session.execute(insert(OrderItemModel), order_items)
+            await cls._reserve_stock(reserved, session)
+        await session.commit()
+        return results
+
+    @classmethod
+    async def _reserve_stock(cls, reserved: dict[int, int],
+                             session: AsyncSession) -> None:
+        '''Списывает остатки товаров одним запросом.'''
+        if not reserved:
+            return
+        await session.execute(
+            update(ProductModel.__table__).where(
+                ProductModel.id == bindparam('product_id')
+            ).values(in_stock=ProductModel.in_stock - bindparam('amount')),
+            [{'product_id': product_id, 'amount': amount}
+             for product_id, amount in reserved.items()]
+        )
+        track_changes(session, ProductModel, reserved)
+
+    @classmethod
+    async def _lock_products(cls, names: set[str], session: AsyncSession
+                             ) -> tuple[dict[str, int], dict[str, int]]:
+        '''
+        Блокирует товары заказов и возвращает их id и остатки
+        по названиям. Строки блокируются по возрастанию id, чтобы
+        параллельные транзакции не ждали друг друга по кругу.
+        '''
+        if len(names) > MAX_BULK_PRODUCTS:
+            raise HTTPException(
+                status_code=400,
+                detail=(f'В заказах может быть не больше '
+                        f'{MAX_BULK_PRODUCTS} разных товаров.'))
+        if not names:
+            return {}, {}
+        query = select(
+            ProductModel.id, ProductModel.name, ProductModel.in_stock
+        ).where(ProductModel.name.in_(names)).order_by(
+            ProductModel.id).with_for_update()
         result = await session.execute(query)
-        order_models = result.scalars().all()
-        orders = [OrderRead.model_validate(
-            order_model
-        ) for order_model in order_models]
+        products = {}
+        stock = {}
+        for product_id, name, in_stock in result:
+            products[name] = product_id
+            stock[name] = in_stock
+        return products, stock
+
+    @classmethod
+    def _check_stock(cls, amounts: dict[str, int],
+                     stock: dict[str, int]) -> Optional[dict]:
+        '''Возвращает ошибку, если заказ нельзя собрать из остатков.'''
+        for name, amount in amounts.items():
+            if name not in stock:
+                return {'status_code': 404,
+                        'detail': f'Товар {name} не найден.'}
+            if stock[name] < amount:
+                return {'status_code': 400,
+                        'detail': (f'Недостаточно {name} для заказа. '
+                                   f'Остаток на складе - {stock[name]}')}
+        return None
+
+    @classmethod
+    async def get_all(cls, session: AsyncSession,
+                      ids: Optional[list[int]] = None,
+                      fields: Optional[list[str]] = None
+                      ) -> list[OrderRead] | list[dict]:
+        '''
+        Возвращает заказы. Если переданы ids, выбирает только их
+        одним запросом, если fields - загружает только эти колонки,
+        а товары заказа подгружает, только когда запрошено поле items.
+        '''
+        if fields is None:
+            query = select(OrderModel)
+            if ids is not None:
+                query = query.where(OrderModel.id.in_(ids))
+            result = await session.execute(query)
+            order_models = result.scalars().all()
+            orders = [OrderRead.model_validate(
+                order_model
+            ) for order_model in order_models]
+            return orders
+
+        fields = check_fields(fields, ORDER_FIELDS)
+        query = select(*(getattr(OrderModel, field)
+                         for field in fields if field != 'items'))
+        if ids is not None:
+            query = query.where(OrderModel.id.in_(ids))
+        result = await session.execute(query)
+        orders = [dict(row) for row in result.mappings()]
+        if 'items' in fields and orders:
+            await cls._attach_items(orders, session)
         return orders
 
     @classmethod
-    async def get_order(cls, order_id: int,
-                        session: AsyncSession) -> OrderRead:
-        query = select(OrderModel).where(OrderModel.id == order_id)
+    async def _attach_items(cls, orders: list[dict],
+                            session: AsyncSession) -> None:
+        '''Подгружает товары для заказов одним запросом.'''
+        query = select(
+            OrderItemModel.order_id,
+            OrderItemModel.product_id,
+            OrderItemModel.amount
+        ).where(OrderItemModel.order_id.in_(
+            [order['id'] for order in orders]))
         result = await session.execute(query)
-        order_model = result.scalar_one_or_none()
+        items = defaultdict(list)
+        for order_id, product_id, amount in result:
+            items[order_id].append({'product_id': product_id,
+                                    'amount': amount})
+        for order in orders:
+            order['items'] = items[order['id']]
 
-        if order_model is None:
+    @classmethod
+    async def get_changes(cls, session: AsyncSession,
+                          since: Optional[str] = None,
+                          limit: int = 100) -> dict:
+        '''Возвращает заказы, измененные после токена since.'''
+        after = decode_token(since)
+        query = select(OrderModel).order_by(
+            OrderModel.change_id, OrderModel.id).limit(limit + 1)
+        if after is not None:
+            query = query.where(
+                tuple_(OrderModel.change_id, OrderModel.id) > after)
+        order_models = (await session.execute(query)).scalars().all()
+
+        changes = [(
+            order_model.change_id, order_model.id,
+            OrderRead.model_validate(order_model)
+        ) for order_model in order_models]
+        return changes_page(changes, since, limit)
+
+    @classmethod
+    async def get_order(cls, order_id: int,
+                        session: AsyncSession,
+                        fields: Optional[list[str]] = None
+                        ) -> OrderRead | dict:
+        orders = await cls.get_all(session, ids=[order_id], fields=fields)
+        if not orders:
             raise HTTPException(status_code=404, detail='Заказ не найден.')
-        return OrderRead.model_validate(order_model)
+        return orders[0]
 
     @classmethod
     async def update_status(cls, order_id: int,
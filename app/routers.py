@@ -1,20 +1,72 @@
-from fastapi import APIRouter, Depends, status
+from typing import List, Optional
+
+from fastapi import (APIRouter, Body, Depends, HTTPException, Query,
+                     Response, status)
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.db import get_db
-from app.orm_query import OrderRepository, ProductRepository
+from app.orm_query import MAX_ID, OrderRepository, ProductRepository
 from app.schemas import OrderAdd, OrderStatusUpdate, ProductAdd
+from app.slow_queries import (require_recorder, slow_query_recorder,
+                              track_route)
 
 product_router = APIRouter(
     prefix='/products',
-    tags=['товары']
+    tags=['товары'],
+    dependencies=[Depends(track_route)]
 )
 
 order_router = APIRouter(
     prefix='/orders',
-    tags=['заказы']
+    tags=['заказы'],
+    dependencies=[Depends(track_route)]
+)
+
+admin_router = APIRouter(
+    prefix='/admin',
+    tags=['администрирование'],
+    dependencies=[Depends(require_recorder)]
 )
 
+MAX_IDS = 1000
+MAX_BULK_ORDERS = 500
+
+IdsQuery = Query(None, pattern=r'^\d+(,\d+)*$',
+                 description='id через запятую')
+FieldsQuery = Query(None, pattern=r'^\w+(,\w+)*$',
+                    description='Возвращаемые поля через запятую')
+ChangesLimitQuery = Query(100, ge=1, le=1000,
+                          description='Размер страницы изменений')
+
+
+def split_ids(ids: Optional[str]) -> Optional[list[int]]:
+    '''
+    Разбирает параметр ids вида 1,2,3. Количество id и их значения
+    ограничены, чтобы не выйти за тип колонки и лимит параметров запроса.
+    '''
+    if ids is None:
+        return None
+    ids = ids.split(',')
+    if len(ids) > MAX_IDS:
+        raise HTTPException(status_code=400,
+                            detail=f'Можно передать не больше {MAX_IDS} id.')
+    # Длину проверяем до int(): слишком длинные строки он не переводит.
+    if any(len(item_id) > len(str(MAX_ID)) for item_id in ids):
+        raise HTTPException(status_code=400,
+                            detail='Некорректный id.')
+    ids = [int(item_id) for item_id in ids]
+    if max(ids) > MAX_ID:
+        raise HTTPException(status_code=400,
+                            detail='Некорректный id.')
+    return ids
+
+
+def split_fields(fields: Optional[str]) -> Optional[list[str]]:
+    '''Разбирает параметр fields вида id,name.'''
+    if fields is None:
+        return None
+    return fields.split(',')
+
 
 @product_router.post('', status_code=status.HTTP_201_CREATED)
 async def add_product(product: ProductAdd,
@@ -24,15 +76,27 @@ async def add_product(product: ProductAdd,
 
 
 @product_router.get('')
-async def get_products(session: AsyncSession = Depends(get_db)):
-    products = await ProductRepository.get_all(session)
+async def get_products(ids: Optional[str] = IdsQuery,
+                       fields: Optional[str] = FieldsQuery,
+                       session: AsyncSession = Depends(get_db)):
+    products = await ProductRepository.get_all(session, split_ids(ids),
+                                               split_fields(fields))
     return {'data': products}
 
 
+@product_router.get('/changes')
+async def get_product_changes(since: Optional[str] = None,
+                              limit: int = ChangesLimitQuery,
+                              session: AsyncSession = Depends(get_db)):
+    return await ProductRepository.get_changes(session, since, limit)
+
+
 @product_router.get('/{product_id}')
 async def get_product(product_id: int,
+                      fields: Optional[str] = FieldsQuery,
                       session: AsyncSession = Depends(get_db)):
-    product = await ProductRepository.get_product(product_id, session)
+    product = await ProductRepository.get_product(product_id, session,
+                                                  split_fields(fields))
     return {'data': product}
 
 
@@ -60,15 +124,39 @@ async def add_order(order: OrderAdd,
     return {'data': order, 'order_id': order_id}
 
 
+@order_router.post('/bulk', status_code=status.HTTP_207_MULTI_STATUS)
+async def add_orders(response: Response,
+                     orders: List[OrderAdd] = Body(max_length=MAX_BULK_ORDERS),
+                     session: AsyncSession = Depends(get_db)):
+    if not orders:
+        response.status_code = status.HTTP_200_OK
+        return {'data': []}
+    results = await OrderRepository.add_orders(orders, session)
+    return {'data': results}
+
+
 @order_router.get('')
-async def get_orders(session: AsyncSession = Depends(get_db)):
-    orders = await OrderRepository.get_all(session)
+async def get_orders(ids: Optional[str] = IdsQuery,
+                     fields: Optional[str] = FieldsQuery,
+                     session: AsyncSession = Depends(get_db)):
+    orders = await OrderRepository.get_all(session, split_ids(ids),
+                                           split_fields(fields))
     return {'data': orders}
 
 
+@order_router.get('/changes')
+async def get_order_changes(since: Optional[str] = None,
+                            limit: int = ChangesLimitQuery,
+                            session: AsyncSession = Depends(get_db)):
+    return await OrderRepository.get_changes(session, since, limit)
+
+
 @order_router.get('/{order_id}')
-async def get_order(order_id: int, session: AsyncSession = Depends(get_db)):
-    order = await OrderRepository.get_order(order_id, session)
+async def get_order(order_id: int,
+                    fields: Optional[str] = FieldsQuery,
+                    session: AsyncSession = Depends(get_db)):
+    order = await OrderRepository.get_order(order_id, session,
+                                            split_fields(fields))
     return {'data': order}
 
 
@@ -77,3 +165,13 @@ async def update_status(order_id: int, status: OrderStatusUpdate,
                         session: AsyncSession = Depends(get_db)):
     order = await OrderRepository.update_status(order_id, status, session)
     return {'data': order}
+
+
+@admin_router.get('/slow-queries')
+async def get_slow_queries():
+    return {'data': slow_query_recorder.records()}
+
+
+@admin_router.delete('/slow-queries', status_code=status.HTTP_204_NO_CONTENT)
+async def clear_slow_queries():
+    slow_query_recorder.clear()
@@ -18,6 +18,7 @@ class ProductAdd(BaseModel):
 
 class ProductRead(ProductAdd):
     id: int
+    updated_at: dt.datetime
     model_config = ConfigDict(from_attributes=True)
 
 
@@ -44,6 +45,7 @@ class OrderRead(BaseModel):
     id: int
     status: StatusModel
     created: dt.datetime
+    updated_at: dt.datetime
     items: List[OrderItemRead]
     model_config = ConfigDict(from_attributes=True)
 
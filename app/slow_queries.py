@@ -0,0 +1,184 @@
+import logging
+import os
+import random
+import re
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+SLOW_QUERY_MS = os.getenv('SLOW_QUERY_MS')
+SLOW_QUERY_EXPLAIN = os.getenv('SLOW_QUERY_EXPLAIN') == '1'
+SLOW_QUERY_ANALYZE_RATE = float(os.getenv('SLOW_QUERY_ANALYZE_RATE', 0))
+SLOW_QUERY_BUFFER = int(os.getenv('SLOW_QUERY_BUFFER', 100))
+
+current_route: ContextVar[Optional[str]] = ContextVar('current_route',
+                                                      default=None)
+analyze_request: ContextVar[bool] = ContextVar('analyze_request',
+                                               default=False)
+
+IN_LIST = re.compile(r'\bIN \(([^()]*)\)', re.IGNORECASE)
+BIND_MARKER = re.compile(r'\?|\$\d+|%s|:\w+')
+SPACES = re.compile(r'\s+')
+
+
+def collapse_in_list(match: re.Match) -> str:
+    if BIND_MARKER.search(match.group(1)) is None:
+        return match.group(0)
+    return 'IN (...)'
+
+
+def normalize_statement(statement: str) -> str:
+    '''Схлопывает пробелы и списки параметров в IN (...).'''
+    statement = SPACES.sub(' ', statement).strip()
+    return IN_LIST.sub(collapse_in_list, statement)
+
+
+def parameters_shape(parameters: Any, executemany: bool) -> Any:
+    '''Возвращает типы параметров запроса без самих значений.'''
+    if executemany:
+        parameters = list(parameters)
+        return {'rows': len(parameters),
+                'row': parameters_shape(parameters[0], False)
+                if parameters else None}
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__
+                for key, value in parameters.items()}
+    return [type(value).__name__ for value in parameters or ()]
+
+
+class SlowQueryRecorder:
+    '''
+    Записывает запросы дольше порога в кольцевой буфер,
+    при необходимости вместе с планом выполнения.
+    '''
+    def __init__(self, threshold_ms: float = 100,
+                 explain: bool = False,
+                 analyze_rate: float = 0,
+                 maxlen: int = 100) -> None:
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self.analyze_rate = analyze_rate
+        self.buffer: deque[dict] = deque(maxlen=maxlen)
+        self.installed = False
+
+    def install(self, engine: AsyncEngine | Engine) -> None:
+        '''Подписывается на события движка.'''
+        engine = getattr(engine, 'sync_engine', engine)
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+        self.installed = True
+
+    def uninstall(self, engine: AsyncEngine | Engine) -> None:
+        '''Отписывается от событий движка.'''
+        engine = getattr(engine, 'sync_engine', engine)
+        event.remove(engine, 'before_cursor_execute', self._before)
+        event.remove(engine, 'after_cursor_execute', self._after)
+        self.installed = False
+
+    def records(self) -> list[dict]:
+        return list(self.buffer)
+
+    def clear(self) -> None:
+        self.buffer.clear()
+
+    def _before(self, conn, cursor, statement, parameters,
+                context, executemany) -> None:
+        # Время храним в контексте выполнения: если запрос упадет,
+        # after_cursor_execute не вызовется и контекст просто уйдет.
+        context._slow_query_start = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters,
+               context, executemany) -> None:
+        start = getattr(context, '_slow_query_start', None)
+        if start is None:
+            return
+        duration_ms = (time.perf_counter() - start) * 1000
+        if duration_ms < self.threshold_ms:
+            return
+        plan = None
+        if self.explain and not executemany:
+            plan = self._explain(conn, statement, parameters)
+        record = {
+            'statement': normalize_statement(statement),
+            'parameters': parameters_shape(parameters, executemany),
+            'route': current_route.get(),
+            'duration_ms': round(duration_ms, 3),
+            'plan': plan,
+        }
+        self.buffer.append(record)
+        logger.warning('Медленный запрос %(duration_ms)s мс (%(route)s): '
+                       '%(statement)s %(parameters)s\n%(plan)s', record)
+
+    def _explain(self, conn, statement: str, parameters: Any) -> str:
+        '''
+        Получает план запроса через отдельный курсор драйвера,
+        чтобы не вызывать события движка повторно.
+        '''
+        # ANALYZE выполняет запрос повторно, поэтому только для SELECT.
+        analyze = analyze_request.get() and (
+            statement.lstrip().upper().startswith('SELECT'))
+        if conn.dialect.name == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        elif conn.dialect.name == 'postgresql' and analyze:
+            prefix = 'EXPLAIN ANALYZE '
+        else:
+            prefix = 'EXPLAIN '
+        # В Postgres ошибка внутри транзакции ломает её целиком,
+        # поэтому EXPLAIN выполняется в точке сохранения.
+        savepoint = conn.dialect.name == 'postgresql'
+        cursor = conn.connection.cursor()
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT slow_query_explain')
+            cursor.execute(prefix + statement, parameters)
+            plan = '\n'.join(str(row[-1]) for row in cursor.fetchall())
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            return plan
+        except Exception as error:
+            if savepoint:
+                try:
+                    cursor.execute(
+                        'ROLLBACK TO SAVEPOINT slow_query_explain')
+                except Exception:
+                    logger.exception('Не удалось откатить EXPLAIN.')
+            return f'EXPLAIN не выполнен: {error}'
+        finally:
+            cursor.close()
+
+
+slow_query_recorder = SlowQueryRecorder(
+    threshold_ms=float(SLOW_QUERY_MS or 0),
+    explain=SLOW_QUERY_EXPLAIN,
+    analyze_rate=SLOW_QUERY_ANALYZE_RATE,
+    maxlen=SLOW_QUERY_BUFFER
+)
+
+
+async def track_route(request: Request) -> None:
+    '''
+    Запоминает маршрут запроса и решает, снимать ли для него
+    EXPLAIN ANALYZE.
+    '''
+    route = request.scope.get('route')
+    path = route.path if route is not None else request.url.path
+    current_route.set(f'{request.method} {path}')
+    analyze_request.set(
+        random.random() < slow_query_recorder.analyze_rate)
+
+
+async def require_recorder() -> None:
+    '''Закрывает доступ к медленным запросам, если запись выключена.'''
+    if not slow_query_recorder.installed:
+        raise HTTPException(status_code=404,
+                            detail='Запись медленных запросов выключена.')
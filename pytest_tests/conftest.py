@@ -7,11 +7,12 @@ from sqlalchemy.ext.asyncio import (AsyncSession, async_sessionmaker,
                                     create_async_engine)
 
 from app.db import Model, OrderItemModel, OrderModel, ProductModel, get_db
-from app.routers import order_router, product_router
+from app.routers import admin_router, order_router, product_router
 
 app = FastAPI()
 app.include_router(product_router)
 app.include_router(order_router)
+app.include_router(admin_router)
 
 engine_test = create_async_engine(
     'sqlite+aiosqlite:///test_db.db',
@@ -5,6 +5,8 @@ from httpx import AsyncClient
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.db import ProductModel
+from app.orm_query import MAX_BULK_PRODUCTS
+from app.routers import MAX_BULK_ORDERS
 
 from .conftest import DESCRIPTION, IN_STOCK, PRICE, PRODUCT_NAME
 
@@ -62,3 +64,85 @@ async def test_not_enough_in_stock_for_order(client: AsyncClient,
     response = await client.post('/orders', json=data)
 
     assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_order_updates_product_changed_at(client: AsyncClient,
+                                                async_db: AsyncSession,
+                                                product: ProductModel):
+    '''При списании товара в заказ меняется время изменения товара.'''
+    before_updated_at = product.updated_at
+    data = {
+        'items': [
+            {'name': product.name,
+             'amount': product.in_stock}
+        ]
+    }
+
+    await client.post('/orders', json=data)
+    await async_db.refresh(product)
+
+    assert product.updated_at > before_updated_at
+
+
+@pytest.mark.asyncio
+async def test_bulk_orders_partial_failure(client: AsyncClient,
+                                           async_db: AsyncSession,
+                                           product: ProductModel):
+    '''
+    Заказы пачки, для которых не хватило товара, не мешают
+    созданию остальных.
+    '''
+    item = {'name': product.name, 'amount': product.in_stock}
+    data = [
+        {'items': [item]},
+        {'items': [item]},
+        {'items': [{'name': 'нет такого товара', 'amount': 1}]},
+    ]
+
+    response = await client.post('/orders/bulk', json=data)
+    results = response.json()['data']
+    await async_db.refresh(product)
+    order_id = results[0]['order_id']
+    order = await client.get(f'/orders/{order_id}')
+
+    assert response.status_code == HTTPStatus.MULTI_STATUS
+    assert [result.get('status_code') for result in results] == [
+        None, HTTPStatus.BAD_REQUEST, HTTPStatus.NOT_FOUND]
+    assert product.in_stock == 0
+    assert order.json()['data']['items'] == [
+        {'product_id': product.id, 'amount': item['amount']}]
+
+
+@pytest.mark.asyncio
+async def test_bulk_orders_limit(client: AsyncClient, async_db: AsyncSession,
+                                 product: ProductModel):
+    '''Нельзя передать слишком большую пачку заказов.'''
+    data = [{'items': [{'name': product.name, 'amount': 1}]}] * (
+        MAX_BULK_ORDERS + 1)
+
+    response = await client.post('/orders/bulk', json=data)
+
+    assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.asyncio
+async def test_bulk_orders_products_limit(client: AsyncClient,
+                                          async_db: AsyncSession):
+    '''Нельзя передать в пачке слишком много разных товаров.'''
+    data = [{'items': [{'name': f'товар {number}', 'amount': 1}
+                       for number in range(MAX_BULK_PRODUCTS + 1)]}]
+
+    response = await client.post('/orders/bulk', json=data)
+
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_bulk_orders_empty(client: AsyncClient,
+                                 async_db: AsyncSession):
+    '''Пустая пачка заказов ничего не создает.'''
+    response = await client.post('/orders/bulk', json=[])
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json() == {'data': []}
@@ -5,10 +5,10 @@ from httpx import AsyncClient
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.db import OrderModel, ProductModel, StatusModel
+from app.db import OrderModel, ProductModel, StatusModel, utcnow
 
 from .conftest import (DESCRIPTION, IN_STOCK, NEW_PRODUCT_NAME, NEW_STATUS,
-                       PRICE, PRODUCT_NAME)
+                       PRICE, PRODUCT_NAME, engine_test)
 
 
 @pytest.mark.asyncio
@@ -156,3 +156,209 @@ async def test_update_status(client: AsyncClient, async_db: AsyncSession,
     assert response.status_code == HTTPStatus.OK
     assert updated_order['data']['status'] == NEW_STATUS
     assert new_order.status == StatusModel.SENT
+
+
+@pytest.mark.asyncio
+async def test_get_products_fields(client: AsyncClient,
+                                   async_db: AsyncSession,
+                                   product: ProductModel):
+    '''Проверка на получение только запрошенных полей товаров.'''
+    response = await client.get('/products',
+                                params={'fields': 'name,in_stock'})
+    data = response.json()
+
+    assert response.status_code == HTTPStatus.OK
+    assert data['data'] == [{'id': product.id,
+                             'name': product.name,
+                             'in_stock': product.in_stock}]
+
+
+@pytest.mark.asyncio
+async def test_get_product_unknown_field(client: AsyncClient,
+                                         async_db: AsyncSession,
+                                         product: ProductModel):
+    '''Нельзя запросить несуществующее поле товара.'''
+    response = await client.get(f'/products/{product.id}',
+                                params={'fields': 'name,secret'})
+
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_get_products_by_ids(client: AsyncClient,
+                                   async_db: AsyncSession,
+                                   product: ProductModel):
+    '''Проверка на получение товаров по списку id.'''
+    other = ProductModel(name=NEW_PRODUCT_NAME, price=PRICE,
+                         in_stock=IN_STOCK)
+    async_db.add(other)
+    await async_db.commit()
+
+    response = await client.get('/products',
+                                params={'ids': f'{product.id},0'})
+    data = response.json()
+
+    assert response.status_code == HTTPStatus.OK
+    assert [item['id'] for item in data['data']] == [product.id]
+
+
+@pytest.mark.asyncio
+async def test_get_orders_fields(client: AsyncClient, async_db: AsyncSession,
+                                 order: OrderModel) -> None:
+    '''Товары заказа возвращаются, только если запрошено поле items.'''
+    response = await client.get('/orders', params={'fields': 'status'})
+    without_items = response.json()['data'][0]
+
+    response = await client.get(f'/orders/{order.id}',
+                                params={'fields': 'items'})
+    with_items = response.json()['data']
+
+    assert without_items == {'id': order.id, 'status': 'pending'}
+    assert with_items == {
+        'id': order.id,
+        'items': [{'product_id': item.product_id, 'amount': item.amount}
+                  for item in order.items]
+    }
+
+
+@pytest.mark.asyncio
+async def test_get_orders_by_ids(client: AsyncClient, async_db: AsyncSession,
+                                 order: OrderModel) -> None:
+    '''Проверка на получение заказов по списку id.'''
+    response = await client.get('/orders', params={'ids': str(order.id)})
+    data = response.json()
+
+    assert response.status_code == HTTPStatus.OK
+    assert [item['id'] for item in data['data']] == [order.id]
+
+
+@pytest.mark.asyncio
+async def test_get_product_changes(client: AsyncClient,
+                                   async_db: AsyncSession,
+                                   product: ProductModel):
+    '''Лента изменений товаров листается по токену и содержит удаления.'''
+    response = await client.get('/products/changes', params={'limit': 1})
+    first_page = response.json()
+
+    await client.delete(f'/products/{product.id}')
+    response = await client.get('/products/changes',
+                                params={'since': first_page['next']})
+    second_page = response.json()
+
+    response = await client.get('/products/changes',
+                                params={'since': second_page['next']})
+    third_page = response.json()
+
+    assert response.status_code == HTTPStatus.OK
+    assert [item['id'] for item in first_page['data']] == [product.id]
+    assert first_page['data'][0]['deleted'] is False
+    assert second_page['data'] == [{'id': product.id,
+                                    'updated_at': second_page['data'][0][
+                                        'updated_at'],
+                                    'deleted': True}]
+    assert third_page == {'data': [], 'next': second_page['next'],
+                          'has_more': False}
+
+
+@pytest.mark.asyncio
+async def test_get_order_changes(client: AsyncClient, async_db: AsyncSession,
+                                 order: OrderModel) -> None:
+    '''Заказ снова попадает в ленту изменений после смены статуса.'''
+    response = await client.get('/orders/changes')
+    first_page = response.json()
+
+    await client.patch(f'/orders/{order.id}/status',
+                       json={'status': NEW_STATUS})
+    response = await client.get('/orders/changes',
+                                params={'since': first_page['next']})
+    second_page = response.json()
+
+    assert [item['id'] for item in first_page['data']] == [order.id]
+    assert [item['status'] for item in second_page['data']] == [NEW_STATUS]
+    assert second_page['next'] != first_page['next']
+
+
+@pytest.mark.asyncio
+async def test_changes_follow_commit_order(client: AsyncClient,
+                                           async_db: AsyncSession,
+                                           product: ProductModel):
+    '''
+    Запись транзакции, которая началась раньше, а закоммичена позже
+    уже прочитанной записи, всё равно попадает в ленту изменений.
+    '''
+    async with AsyncSession(engine_test,
+                            expire_on_commit=False) as slow_session:
+        slow_product = ProductModel(name=NEW_PRODUCT_NAME, price=PRICE,
+                                    in_stock=IN_STOCK, updated_at=utcnow())
+        slow_session.add(slow_product)
+
+        data = {'name': PRODUCT_NAME, 'price': PRICE, 'in_stock': 0}
+        await client.put(f'/products/{product.id}', json=data)
+        response = await client.get('/products/changes')
+        first_page = response.json()
+
+        await slow_session.commit()
+
+    response = await client.get('/products/changes',
+                                params={'since': first_page['next']})
+    second_page = response.json()
+
+    assert [item['id'] for item in first_page['data']] == [product.id]
+    assert first_page['data'][0]['updated_at'] > (
+        slow_product.updated_at.isoformat())
+    assert [item['id'] for item in second_page['data']] == [slow_product.id]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('token', [
+    'token',
+    '1',
+    '1_2_3',
+    '-1_1',
+    '2024-01-01T00:00:00+03:00_1',
+    f'1_{2 ** 31}',
+    f'{2 ** 63}_1',
+])
+async def test_get_changes_bad_token(client: AsyncClient,
+                                     async_db: AsyncSession, token: str):
+    '''Нельзя передать некорректный токен изменений.'''
+    response = await client.get('/products/changes',
+                                params={'since': token})
+
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_get_products_bad_ids(client: AsyncClient,
+                                    async_db: AsyncSession):
+    '''Нельзя передать слишком большой id или слишком много id.'''
+    too_big = await client.get('/products',
+                               params={'ids': '99999999999999999999'})
+    too_long = await client.get('/products', params={'ids': '1' * 5000})
+    too_many = await client.get(
+        '/orders', params={'ids': ','.join(['1'] * 1001)})
+
+    assert too_big.status_code == HTTPStatus.BAD_REQUEST
+    assert too_long.status_code == HTTPStatus.BAD_REQUEST
+    assert too_many.status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.mark.asyncio
+async def test_bulk_orders_in_changes(client: AsyncClient,
+                                      async_db: AsyncSession,
+                                      product: ProductModel):
+    '''Заказы и остатки, измененные пачкой, попадают в ленты изменений.'''
+    response = await client.get('/products/changes')
+    since = response.json()['next']
+
+    data = [{'items': [{'name': product.name, 'amount': product.in_stock}]}]
+    response = await client.post('/orders/bulk', json=data)
+    order_id = response.json()['data'][0]['order_id']
+
+    products = (await client.get('/products/changes',
+                                 params={'since': since})).json()
+    orders = (await client.get('/orders/changes')).json()
+
+    assert [item['in_stock'] for item in products['data']] == [0]
+    assert [item['id'] for item in orders['data']] == [order_id]
+    assert products['next'].split('_')[0] == orders['next'].split('_')[0]
@@ -0,0 +1,104 @@
+import time
+from http import HTTPStatus
+
+import pytest
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import ProductModel
+from app.slow_queries import normalize_statement, slow_query_recorder
+
+from .conftest import IN_STOCK, PRICE, engine_test
+
+
+@pytest.fixture
+def recorder():
+    '''Включает запись всех запросов с планами выполнения.'''
+    threshold_ms = slow_query_recorder.threshold_ms
+    explain = slow_query_recorder.explain
+    slow_query_recorder.threshold_ms = 0
+    slow_query_recorder.explain = True
+    slow_query_recorder.install(engine_test)
+    yield slow_query_recorder
+    slow_query_recorder.uninstall(engine_test)
+    slow_query_recorder.clear()
+    slow_query_recorder.threshold_ms = threshold_ms
+    slow_query_recorder.explain = explain
+
+
+def test_normalize_statement():
+    '''Списки параметров и пробелы схлопываются.'''
+    statement = 'SELECT id\n  FROM product WHERE id IN (?, ?, ?)'
+
+    assert normalize_statement(statement) == (
+        'SELECT id FROM product WHERE id IN (...)')
+    assert normalize_statement('SELECT id FROM product WHERE id IN (?)') == (
+        'SELECT id FROM product WHERE id IN (...)')
+
+
+def test_normalize_statement_nested_parens():
+    '''Вложенные скобки и JOIN ( не ломают и не замедляют нормализацию.'''
+    statement = ('SELECT id FROM product JOIN (SELECT 1) AS one ON 1 = 1 '
+                 'WHERE name IN (' + '?, ' * 40 + 'lower(name))')
+
+    start = time.perf_counter()
+    normalized = normalize_statement(statement)
+
+    assert time.perf_counter() - start < 0.1
+    assert normalized == statement
+
+
+@pytest.mark.asyncio
+async def test_slow_query_recorded(client: AsyncClient,
+                                   async_db: AsyncSession,
+                                   product: ProductModel, recorder):
+    '''Медленный запрос попадает в буфер с маршрутом и планом.'''
+    await client.get(f'/products/{product.id}')
+
+    response = await client.get('/admin/slow-queries')
+    records = response.json()['data']
+    record = next(record for record in records
+                  if record['route'] == 'GET /products/{product_id}')
+
+    assert response.status_code == HTTPStatus.OK
+    assert record['statement'].startswith('SELECT')
+    assert record['parameters'] == ['int']
+    assert 'SEARCH product' in record['plan']
+
+
+@pytest.mark.asyncio
+async def test_clear_slow_queries(client: AsyncClient,
+                                  async_db: AsyncSession,
+                                  product: ProductModel, recorder):
+    '''Буфер медленных запросов очищается.'''
+    await client.get('/products')
+
+    response = await client.delete('/admin/slow-queries')
+
+    assert response.status_code == HTTPStatus.NO_CONTENT
+    assert slow_query_recorder.records() == []
+
+
+@pytest.mark.asyncio
+async def test_slow_queries_disabled(client: AsyncClient,
+                                     async_db: AsyncSession):
+    '''Без включенной записи медленные запросы недоступны.'''
+    response = await client.get('/admin/slow-queries')
+
+    assert response.status_code == HTTPStatus.NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_slow_query_logged(client: AsyncClient,
+                                 async_db: AsyncSession,
+                                 product: ProductModel, recorder, caplog):
+    '''Медленный запрос пишется в лог, даже если другой запрос упал.'''
+    data = {'name': product.name, 'price': PRICE, 'in_stock': IN_STOCK}
+
+    response = await client.post('/products', json=data)
+    caplog.clear()
+    await client.get('/products')
+
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    assert 'GET /products' in caplog.text
+    assert caplog.records[0].levelname == 'WARNING'